@@ -28,10 +28,18 @@ with x. If such a line exists, change the priority from 1000 to
 from typing import Any
 from typing import List
 from typing import Dict
+from typing import Tuple
+from typing import Set
+import os
 import re
+import json
 import unicodedata
+import urllib.parse
 import urllib.request
 import logging
+import functools
+import operator
+import concurrent.futures
 
 IMPORT_CHINESE_VARIANTS_SUCCESSFUL = False
 try:
@@ -40,6 +48,16 @@ try:
 except (ImportError,):
     IMPORT_CHINESE_VARIANTS_SUCCESSFUL = False
 
+IMPORT_URLLIB3_SUCCESSFUL = False
+try:
+    import urllib3
+    IMPORT_URLLIB3_SUCCESSFUL = True
+except (ImportError,):
+    IMPORT_URLLIB3_SUCCESSFUL = False
+
+BEGIN_TABLE_PATTERN = re.compile(r'^BEGIN_TABLE.*(\n|$)', re.MULTILINE)
+END_TABLE_PATTERN = re.compile(r'^END_TABLE', re.MULTILINE)
+
 def parse_args() -> Any:
     '''Parse the command line arguments'''
     import argparse
@@ -58,11 +76,18 @@ def parse_args() -> Any:
                         type=str,
                         default='quick5.txt.new',
                         help='output file, default is %(default)s')
+    parser.add_argument('-n', '--no-cache',
+                        action='store_true',
+                        help=('do not use the results of earlier lookups '
+                              + 'in the dictionary of Taiwan, look up '
+                              + 'everything again and refresh the cache '
+                              + 'file %s' % TAIWAN_DICTIONARY_CACHE))
     parser.add_argument('-d', '--debug',
                         action='store_true',
                         help='print debugging output')
     return parser.parse_args()
 
+@functools.lru_cache(maxsize=None)
 def big5_code(phrase: str) -> bytes:
     '''
     Encode a string in Big5 or, if that is not possible,
@@ -76,120 +101,310 @@ def big5_code(phrase: str) -> bytes:
         big5 = b'\xff\xff' # higher than any Big5 code
     return big5
 
-def improve_quick5(inputfilename: str, outputfilename: str) -> None:
+def is_cjk_compatibility_ideograph(character: str) -> bool:
+    '''
+    Check whether a character is in one of the CJK Compatibility
+    Ideographs blocks.
+
+    This is much cheaper than looking up the Unicode name of
+    the character.
+
+    :param character: The character to check
+    '''
+    code_point = ord(character)
+    return (0xF900 <= code_point <= 0xFAFF
+            or 0x2F800 <= code_point <= 0x2FA1F)
+
+def taiwan_dictionary_url(chinese_character: str) -> str:
+    '''
+    Return the URL to look up a character in the dictionary
+    of the Ministry of Education of Taiwan.
+
+    :param chinese_character: The character to look up
+    '''
+    utf8_for_url = urllib.parse.quote(chinese_character, safe='')
+    return (f'https://dict.revised.moe.edu.tw/'
+            f'search.jsp?md=1&word={utf8_for_url}#searchL')
+
+# The dictionary of Taiwan returns a page containing "No data found"
+# if a character is not found. The page is UTF-8 encoded, searching
+# for the encoded message avoids decoding the whole page:
+TAIWAN_DICTIONARY_NOT_FOUND = '查無資料'.encode('utf-8')
+
+# Do not send too many requests to the dictionary server at once:
+MAX_TAIWAN_DICTIONARY_LOOKUPS = 4
+
+TAIWAN_DICTIONARY_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'improve_quick5', 'taiwan.json')
+
+def read_taiwan_dictionary_cache() -> Dict[str, bool]:
+    '''
+    Read the results of earlier lookups in the dictionary of Taiwan.
+
+    :return: A dictionary mapping the hexadecimal code point of
+             a character to the result of the lookup
+    '''
+    if not os.path.exists(TAIWAN_DICTIONARY_CACHE):
+        return {}
+    logging.info('Reading Taiwan dictionary cache %s',
+                 TAIWAN_DICTIONARY_CACHE)
+    try:
+        with open(TAIWAN_DICTIONARY_CACHE, 'r') as cachefile:
+            cache: Dict[str, bool] = json.load(cachefile)
+            return cache
+    except (OSError, ValueError) as error:
+        logging.warning('Cannot read %s: %s',
+                        TAIWAN_DICTIONARY_CACHE, error)
+        return {}
+
+def write_taiwan_dictionary_cache(cache: Dict[str, bool]) -> None:
+    '''
+    Write the results of the lookups in the dictionary of Taiwan
+    to be reused by the next run.
+
+    :param cache: A dictionary mapping the hexadecimal code point of
+                  a character to the result of the lookup
+    '''
+    logging.info('Writing Taiwan dictionary cache %s',
+                 TAIWAN_DICTIONARY_CACHE)
+    os.makedirs(os.path.dirname(TAIWAN_DICTIONARY_CACHE), exist_ok=True)
+    tmp_filename = TAIWAN_DICTIONARY_CACHE + '.tmp'
+    with open(tmp_filename, 'w') as cachefile:
+        json.dump(cache, cachefile, indent=0, sort_keys=True)
+    os.replace(tmp_filename, TAIWAN_DICTIONARY_CACHE)
+
+def used_in_taiwan(
+        chinese_characters: List[str],
+        use_cache: bool = True) -> Dict[str, bool]:
+    '''
+    Check which characters are found in the dictionary of the Ministry
+    of Education of Taiwan.
+
+    Characters which can be encoded in Big5 are used in Taiwan
+    and are not looked up. The other characters are looked up
+    concurrently. If urllib3 is available, the connections to the
+    server are kept alive and reused. Results of earlier runs are
+    read from a cache file and only the characters not found there
+    are looked up. Only successful lookups are added to the cache.
+
+    :param chinese_characters: The characters to look up
+    :param use_cache: Whether to use the results of earlier runs.
+                      If False, all characters are looked up again
+                      and the results replace those in the cache.
+    :return: A dictionary mapping each character to True if it
+             was found in the dictionary and to False if not
+    '''
+    pool = None
+    if IMPORT_URLLIB3_SUCCESSFUL:
+        pool = urllib3.PoolManager(
+            maxsize=MAX_TAIWAN_DICTIONARY_LOOKUPS, num_pools=1)
+
+    def fetch(url: str) -> bytes:
+        if pool:
+            # Retry if the server is overloaded or has a temporary
+            # problem, waiting longer each time:
+            response = pool.request(
+                'GET', url, timeout=10,
+                retries=urllib3.Retry(
+                    3,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    backoff_factor=1))
+            if response.status != 200:
+                raise urllib3.exceptions.HTTPError(
+                    f'{url}: HTTP status {response.status}')
+            return bytes(response.data)
+        # urlopen() raises HTTPError for 4xx and 5xx responses:
+        with urllib.request.urlopen(url, timeout=10) as f:
+            return bytes(f.read())
+
+    def lookup(chinese_character: str) -> Tuple[str, bool]:
+        page = fetch(taiwan_dictionary_url(chinese_character))
+        return (chinese_character,
+                bool(page) and TAIWAN_DICTIONARY_NOT_FOUND not in page)
+
+    results: Dict[str, bool] = {}
+    cache = read_taiwan_dictionary_cache()
+    cached_results = cache if use_cache else {}
+    uncached_characters = []
+    for chinese_character in chinese_characters:
+        cache_key = f'{ord(chinese_character):X}'
+        if big5_code(chinese_character) != b'\xff\xff':
+            results[chinese_character] = True
+        elif cache_key in cached_results:
+            results[chinese_character] = cached_results[cache_key]
+        else:
+            uncached_characters.append(chinese_character)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_TAIWAN_DICTIONARY_LOOKUPS) as executor:
+            for (chinese_character, found) in executor.map(
+                    lookup, uncached_characters):
+                cache[f'{ord(chinese_character):X}'] = found
+                results[chinese_character] = found
+    finally:
+        if uncached_characters:
+            write_taiwan_dictionary_cache(cache)
+    return results
+
+def improve_quick5(
+        inputfilename: str,
+        outputfilename: str,
+        use_cache: bool = True) -> None:
     '''
     Read the quick5.txt file and write an improved version
+
+    :param inputfilename: The quick5.txt file to read
+    :param outputfilename: The file to write the improved table to
+    :param use_cache: Whether to use the results of earlier lookups
+                      in the dictionary of Taiwan
     '''
-    head: List[str] = []
-    tail: List[str] = []
-    table: Dict[Tuple[str, str], int] = {}
-    reading_head = True
-    reading_table = True
-    reading_tail = True
+    # Keyed by (input, chinese_character). Joining both into one
+    # string key would be slower: the new string has to be hashed
+    # completely and split again later, whereas the hash of the tuple
+    # combines the cached hashes of the two strings.
+    weights: Dict[Tuple[str, str], int] = {}
+    comments: Dict[Tuple[str, str], str] = {}
+    characters_with_x_input: Set[str] = set()
+    characters_with_other_input: Set[str] = set()
     with open(inputfilename, 'r') as inputfile:
         logging.info("input file=%s", inputfile)
-        for line in inputfile:
-            if reading_head and not line.startswith('BEGIN_TABLE'):
-                head.append(line)
-                continue
-            if reading_head:
-                logging.info('Header read.')
-                head.append('BEGIN_TABLE\n')
-                reading_head = False
+        content = inputfile.read()
+    head = content
+    table = ''
+    tail = ''
+    begin_table = BEGIN_TABLE_PATTERN.search(content)
+    if begin_table:
+        logging.info('Header read.')
+        head = content[:begin_table.start()] + 'BEGIN_TABLE\n'
+        table = content[begin_table.end():]
+        end_table = END_TABLE_PATTERN.search(content, begin_table.end())
+        if end_table:
+            logging.info('Table read.')
+            table = content[begin_table.end():end_table.start()]
+            tail = content[end_table.start():]
+    for line in table.split('\n'):
+        if not line:
+            continue
+        fields = line.split('\t', 3)
+        if len(fields) < 4:
+            # Most lines have no comment, appending to the list
+            # is cheaper than creating a padded copy:
+            fields.append('')
+        (input,
+         chinese_character,
+         weight,
+         comment) = fields
+        key = (input, chinese_character)
+        int_weight = int(weight)
+        first_weight = weights.get(key)
+        if first_weight is None:
+            weights[key] = int_weight
+            comments[key] = comment
+            if input.startswith('x'):
+                characters_with_x_input.add(chinese_character)
+            else:
+                characters_with_other_input.add(chinese_character)
+            continue
+        logging.warning(
+            'duplicate %s %s first weight=%s second weight=%s',
+            input, chinese_character,
+            first_weight, weight)
+        if int_weight > first_weight:
+            weights[key] = int_weight
+    number_of_problems_with_chinese_variants: int = 0
+    found_in_taiwan_dictionary: Dict[str, bool] = {}
+    # Characters classified as simplified only which are nevertheless
+    # found in the dictionary of Taiwan are problems of the
+    # classification. Looking them up needs the network, do that in
+    # the background while the table is processed:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        taiwan_dictionary_lookup = None
+        if IMPORT_CHINESE_VARIANTS_SUCCESSFUL:
+            taiwan_dictionary_lookup = executor.submit(
+                used_in_taiwan,
+                [chinese_character
+                 for chinese_character in dict.fromkeys(
+                     chinese_character for (_, chinese_character) in weights)
+                 if chinese_variants.detect_chinese_category(
+                     chinese_character) == 1],
+                use_cache)
+        # Index the table by Chinese character to find all inputs
+        # for a character without probing every possible input:
+        valid_input_chars_without_x = set('abcdefghijklmnopqrstuvwyz')
+        inputs_by_character: Dict[str, List[str]] = {}
+        for (input, chinese_character) in weights:
+            inputs_by_character.setdefault(
+                chinese_character, []).append(input)
+        # Only characters which have both an x input and another input
+        # can get demoted. Demote the inputs of one or two letters
+        # other than x:
+        for chinese_character in (characters_with_x_input
+                                  & characters_with_other_input):
+            for input in inputs_by_character[chinese_character]:
+                if (len(input) <= 2
+                        and set(input) <= valid_input_chars_without_x):
+                    weights[(input, chinese_character)] = 900
+        # Look up the Unicode names and decompositions only once per
+        # character and only for characters which can be compatibility
+        # ideographs at all:
+        compatibility_ideographs: Dict[str, Tuple[str, str, str]] = {}
+        for chinese_character in inputs_by_character:
+            if not is_cjk_compatibility_ideograph(chinese_character):
                 continue
-            if reading_table and not line.startswith('END_TABLE'):
-                stripped_line = line.strip().split('\t')
-                if len(stripped_line) < 4:
-                    stripped_line.append('')
-                (input,
-                 chinese_character,
-                 weight,
-                 comment) = stripped_line
-                if (input, chinese_character) in table:
-                    first_weight = table[(input, chinese_character)]['weight']
-                    logging.warning(
-                        'duplicate %s %s first weight=%s second weight=%s',
-                        input, chinese_character,
-                        first_weight, weight)
-                    table[(input, chinese_character)]['weight'] = max(
-                        int(weight), int(first_weight))
-                    continue
-                table[(input, chinese_character)] = {
-                    'weight': int(weight),
-                    'comment':  comment,
-                    }
+            unicode_name = unicodedata.name(chinese_character, '')
+            if not unicode_name.startswith('CJK COMPATIBILITY IDEOGRAPH'):
                 continue
-            if reading_table:
-                logging.info('Table read.')
-                reading_table = False
-            tail.append(line)
-    for (input, chinese_character) in table:
-        unicode_name = unicodedata.name(chinese_character, '')
-        if unicode_name.startswith('CJK COMPATIBILITY IDEOGRAPH'):
             unicode_decomposition = unicodedata.decomposition(
                 chinese_character)
             unicode_decomposition_char = ''
             if unicode_decomposition:
                 unicode_decomposition_char = chr(
                     int(unicode_decomposition, 16))
+            compatibility_ideographs[chinese_character] = (
+                unicode_name,
+                unicode_decomposition,
+                unicode_decomposition_char)
+        if taiwan_dictionary_lookup is not None:
+            found_in_taiwan_dictionary = taiwan_dictionary_lookup.result()
+    for (input, chinese_character) in weights:
+        if chinese_character in compatibility_ideographs:
+            (unicode_name,
+             unicode_decomposition,
+             unicode_decomposition_char) = compatibility_ideographs[
+                 chinese_character]
             logging.info('%s\t%s\t%s %s %s %s',
                          input,
                          chinese_character,
-                         table[(input, chinese_character)]['weight'],
+                         weights[(input, chinese_character)],
                          unicode_name,
                          unicode_decomposition,
                          unicode_decomposition_char)
-        if IMPORT_CHINESE_VARIANTS_SUCCESSFUL:
-            number_of_problems_with_chinese_variants: int = 0
-            category = chinese_variants.detect_chinese_category(
-                chinese_character)
-            if category == 1:
-                used_in_taiwan = False
-                utf8_for_url = ''
-                for byte in chinese_character.encode('utf-8'):
-                    utf8_for_url += f'%{byte:X}'
-                url = (f'https://dict.revised.moe.edu.tw/'
-                       f'search.jsp?md=1&word={utf8_for_url}#searchL')
-                with urllib.request.urlopen(url) as f:
-                    page = f.read().decode('utf-8')
-                    if page and '查無資料' not in page:
-                        used_in_taiwan = True
-                if used_in_taiwan:
-                    number_of_problems_with_chinese_variants += 1
-                    logging.info(
-                        'Classified as simplified only: %s\t%s\tused_in_taiwan=%s',
-                        input, chinese_character, repr(used_in_taiwan))
-        if input.startswith('x'):
-            valid_input_chars_without_x = 'abcdefghijklmnopqrstuvwyz'
-            for input1 in valid_input_chars_without_x:
-                if (input1, chinese_character) in table:
-                    table[(input1, chinese_character)]['weight'] = 900
-                for input2 in valid_input_chars_without_x:
-                    if (input1 + input2, chinese_character) in table:
-                        table[(input1 + input2, chinese_character)]['weight'] = 900
+        if found_in_taiwan_dictionary.get(chinese_character, False):
+            number_of_problems_with_chinese_variants += 1
+            logging.info(
+                'Classified as simplified only: %s\t%s\tused_in_taiwan=True',
+                input, chinese_character)
     if IMPORT_CHINESE_VARIANTS_SUCCESSFUL:
         logging.info(
             'number_of_problems_with_chinese_variants=%s',
             number_of_problems_with_chinese_variants)
-    with open(outputfilename, 'w') as outputfile:
+    # Sort by input, then by descending weight, then by Unicode
+    # code point:
+    rows = [((input, -weight, ord(chinese_character)),
+             input, chinese_character, weight,
+             comments[(input, chinese_character)])
+            for ((input, chinese_character), weight) in weights.items()]
+    rows.sort(key=operator.itemgetter(0))
+    with open(outputfilename, 'w', buffering=1048576) as outputfile:
         logging.info("output file=%s", outputfile)
-        for line in head:
-            outputfile.write('%s' % line)
-        for ((input, chinese_character), value) in sorted(table.items(),
-                                                   key=lambda x: (
-                                                       x[0][0],
-                                                       -x[1]['weight'],
-                                                       ord(x[0][1]), # Unicode code point
-                                                   )):
-            if value['comment']:
-                outputfile.write('%s\t%s\t%s\t%s\n'
-                                 % (input, chinese_character, value['weight'],
-                                    value['comment']))
-            else:
-                outputfile.write('%s\t%s\t%s\n'
-                                 % (input, chinese_character, value['weight']))
-        for line in tail:
-            outputfile.write('%s' % line)
+        outputfile.write(head)
+        outputfile.write(''.join([
+            f'{input}\t{chinese_character}\t{weight}\t{comment}\n'
+            if comment else
+            f'{input}\t{chinese_character}\t{weight}\n'
+            for (_, input, chinese_character, weight, comment) in rows]))
+        outputfile.write(tail)
 
 def main() -> None:
     '''Main program'''
@@ -198,7 +413,8 @@ def main() -> None:
     if args.debug:
         log_level = logging.DEBUG
     logging.basicConfig(format="%(levelname)s: %(message)s", level=log_level)
-    improve_quick5(args.inputfilename, args.outputfilename)
+    improve_quick5(args.inputfilename, args.outputfilename,
+                   use_cache=not args.no_cache)
 
 if __name__ == '__main__':
     main()